@@ -25,11 +25,6 @@ import random
 # class (structure) definitions
 #-------------------------------------------------------------------------------
 
-class cPts: # duct segment end-point structure
-  def __init__(self, position, radius):
-    self.position = position
-    self.radius = radius
-    
 class cDseg: # duct segment structure
   def __init__(self, idx_out, idx_in, ctype):
     self.idx_out = idx_out
@@ -40,8 +35,6 @@ class cDseg: # duct segment structure
 # global constants
 #-------------------------------------------------------------------------------
 
-main_collection = bpy.context.collection
-
 # cell type dictionary
 cell_types = {  
   "acinar"       : {"color":(1.000, 0.055, 0.060, 1.0), "pressure":1.8, "stiffness":0.20},
@@ -49,14 +42,18 @@ cell_types = {
   "striated"     : {"color":(1.000, 0.200, 0.240, 1.0), "pressure":1.2, "stiffness":0.11}    
 }
 
-# duct segment end-points: position, radius
-PTS = (
-  cPts(mathutils.Vector((0.0, 0.0, 0.0)), 4.0), 
-  cPts(mathutils.Vector((0.0, 0.0, 10.0)), 3.7), 
-  cPts(mathutils.Vector((0.0, 0.0, 20.0)), 1.5),
-  cPts(mathutils.Vector((0.0, 0.0, 40.0)), 1.5),
-  cPts(mathutils.Vector((0.0, 0.0, 45.0)), 0.7), 
-  cPts(mathutils.Vector((0.0, 0.0, 52.0)), 0.05))
+# cell cloth modifier settings (common to all cell types)
+cloth_settings = {"use_internal_springs":False, "use_pressure":True, "tension_stiffness":0.01}
+
+# duct segment end-points: positions, radii
+PTS_pos = np.array((
+  (0.0, 0.0, 0.0), 
+  (0.0, 0.0, 10.0), 
+  (0.0, 0.0, 20.0),
+  (0.0, 0.0, 40.0),
+  (0.0, 0.0, 45.0), 
+  (0.0, 0.0, 52.0)))
+PTS_r = np.array((4.0, 3.7, 1.5, 1.5, 0.7, 0.05))
 
 # duct segment connectivity
 #   - final duct out segment listed first
@@ -68,141 +65,216 @@ DSEG = (
   cDseg(3, 4, "intercalated"),
   cDseg(4, 5, "acinar"))
 
+#---- duct segment cone transform and depth
+def seg_xform(s):
+  p1 = mathutils.Vector(PTS_pos[s.idx_out])
+  v = mathutils.Vector(PTS_pos[s.idx_in]) - p1
+  r = v.to_track_quat('Z', 'X').to_matrix().to_4x4()
+  return (mathutils.Matrix.Translation(p1 + v / 2.0) @ r, v.length)
+
+# duct segment cone transforms and depths (all of the inputs are constants)
+DSEG_xform = tuple(seg_xform(s) for s in DSEG)
+
 C_RADIUS = 1               # cell seed radius
 C_OFFSET = 1.5 * C_RADIUS  # cell seed radial offset from inner duct wall
 A_RADIUS = 8.0            # radius of acinii 
-EPSILON = 0.005            # a small numerical offset
+D_VOXEL = 0.45 * C_RADIUS  # duct wall remesh voxel size (the old octree depth 7 inner wall resolution,
+                           #   duct tips narrower than about one voxel are still not resolved)
+A_SEP = 2.8 * C_RADIUS     # minimum acinar cell seed separation
+D_SEP = 2.5 * C_RADIUS     # minimum duct cell seed separation
+HASH_SIZE = max(A_SEP, D_SEP) # spatial hash bucket size (largest cell seed separation)
 
 #-------------------------------------------------------------------------------
 # global variables
 #-------------------------------------------------------------------------------
 
-cell_centers = list()
+cell_centers = np.empty((512, 3), np.float32) # cell seed centers (the first n_cells rows are in use)
+n_cells = 0
+cell_hash = dict()               # spatial hash of cell seed centers: bucket -> list of indices
+rng = np.random.default_rng()    # random number generator for batches of cell seed candidates
 
 #-------------------------------------------------------------------------------
 # FUNCTION DEFINITIONS
 #-------------------------------------------------------------------------------
 
-#---- combine mesh objects using boolean union modifier
-def combine(prev):
-  bpy.ops.object.modifier_add(type = 'BOOLEAN')
-  bpy.context.object.modifiers["Boolean"].operation = "UNION"
-  bpy.context.object.modifiers["Boolean"].object = prev
-  bpy.context.object.modifiers["Boolean"].double_threshold = 0.0
-  bpy.ops.object.modifier_apply(modifier = "Boolean")
-  current = bpy.context.object
-  # delete previous object
-  bpy.ops.object.select_all(action = 'DESELECT')
-  prev.select_set(True) # required by bpy.ops
-  bpy.ops.object.delete()
-  return(current)
-
-#---- create a duct segment given endpoints and radii
-def create_seg(p1, r1, p2, r2):
-  d = (p2 - p1).length
-  l = p1 + (p2 - p1) / 2.0
-  r = (p2 - p1).to_track_quat('Z', 'X').to_euler()
-  bpy.ops.mesh.primitive_cone_add(radius1 = r1, radius2 = r2, depth = d, location = l, rotation = r, end_fill_type = 'NGON')
-  return
+#---- add an ico-sphere to a bmesh (the radius argument was named "diameter" before Blender 3.0)
+def add_icosphere(bm, subdivisions, radius, matrix):
+  if bpy.app.version >= (3, 0, 0):
+    return(bmesh.ops.create_icosphere(bm, subdivisions = subdivisions, radius = radius, matrix = matrix))
+  return(bmesh.ops.create_icosphere(bm, subdivisions = subdivisions, diameter = radius, matrix = matrix))
+
+#---- add a cone to a bmesh (the radius arguments were named "diameter1/2" before Blender 3.0)
+def add_cone(bm, cap_ends, segments, radius1, radius2, depth, matrix):
+  if bpy.app.version >= (3, 0, 0):
+    return(bmesh.ops.create_cone(bm, cap_ends = cap_ends, segments = segments, radius1 = radius1, radius2 = radius2, depth = depth, matrix = matrix))
+  return(bmesh.ops.create_cone(bm, cap_ends = cap_ends, segments = segments, diameter1 = radius1, diameter2 = radius2, depth = depth, matrix = matrix))
+
+#---- create an (open ended) duct segment given its DSEG index and end radii, return its end edge loops
+def create_seg(bm, i, r1, r2):
+  m, d = DSEG_xform[i]
+  verts = add_cone(bm, False, 32, r1, r2, d, m)["verts"]
+  p1 = m @ mathutils.Vector((0.0, 0.0, -0.5 * d)) # radius1 end
+  p2 = m @ mathutils.Vector((0.0, 0.0, 0.5 * d))  # radius2 end
+  rim = list({e for v in verts for e in v.link_edges if e.is_boundary})
+  out_rim = [e for e in rim if (e.verts[0].co - p1).length < (e.verts[0].co - p2).length]
+  in_rim = [e for e in rim if (e.verts[0].co - p1).length > (e.verts[0].co - p2).length]
+  return(out_rim, in_rim)
 
 #---- create and combine duct segments
 def create_duct(offset):
-  prev = None
+  bm = bmesh.new() # the duct segments, welded end to end, plus the (overlapping) spheres
+  rims = list()
 
   # create duct segments
-  for s in DSEG:
-    p1 = PTS[s.idx_out].position
-    r1 = PTS[s.idx_out].radius + offset
-    p2 = PTS[s.idx_in].position
+  for i, s in enumerate(DSEG):
+    r1 = PTS_r[s.idx_out] + offset
     if not(offset == 0) and s.ctype == "acinar": # outer wall of acinus?
       r2 = A_RADIUS                      # use acinii radius
     else:   
-      r2 = PTS[s.idx_in].radius + offset # use duct wall radius
+      r2 = PTS_r[s.idx_in] + offset # use duct wall radius
 
-    # sphere (in)
-    bpy.ops.mesh.primitive_ico_sphere_add(subdivisions = 4, radius = (1.0 + EPSILON)*r2, location = p2)
+    # sphere (in), rounds the joint (or forms the acinus), the remesh below merges it
+    m = mathutils.Matrix.Translation(mathutils.Vector(PTS_pos[s.idx_in]))
     if not(offset == 0) and s.ctype == "acinar": # outer wall of acinus?
-      bpy.context.object.scale = (1.0,1.0,1.5)
-    if not prev:
-      prev = bpy.context.object
-    else:
-      prev = combine(prev)
+      m = m @ mathutils.Matrix.Diagonal((1.0, 1.0, 1.5, 1.0))
+    add_icosphere(bm, 4, r2, m)
 
     # cone
-    create_seg(p1, r1, p2, r2)
-    prev = combine(prev)
+    rims.append(create_seg(bm, i, r1, r2))
+
+  # weld each segment to the (coincident) in end of the previous one
+  for (_, prev_in), (out, _) in zip(rims[:-1], rims[1:]):
+    bmesh.ops.bridge_loops(bm, edges = prev_in + out, use_merge = True)
+  bmesh.ops.contextual_create(bm, geom = rims[0][0])  # ngon end fill (duct out)
+  bmesh.ops.contextual_create(bm, geom = rims[-1][1]) # ngon end fill
+  bmesh.ops.recalc_face_normals(bm, faces = bm.faces[:])
 
   if offset == 0:
-    bpy.context.object.name = "InnerWall"
+    name = "InnerWall"
   else:
-    bpy.context.object.name = "OuterWall"
-
-  # remesh the duct object
-  prev.select_set(True) # required by bpy.ops
-  bpy.ops.object.modifier_add(type = 'REMESH')
-  bpy.context.object.modifiers["Remesh"].mode = "SMOOTH"
-  bpy.context.object.modifiers["Remesh"].octree_depth = 7
-  bpy.ops.object.modifier_apply(modifier = "Remesh")
+    name = "OuterWall"
+  mesh = bpy.data.meshes.new(name)
+  bm.to_mesh(mesh)
+  bm.free()
+  duct = bpy.data.objects.new(name, mesh)
+  bpy.data.collections['Duct'].objects.link(duct)
+
+  # remesh the duct object (applied through the evaluated depsgraph rather than bpy.ops)
+  remesh = duct.modifiers.new("Remesh", 'REMESH')
+  remesh.mode = "VOXEL"
+  remesh.voxel_size = D_VOXEL
+  duct.data = bpy.data.meshes.new_from_object(duct.evaluated_get(bpy.context.evaluated_depsgraph_get()))
+  duct.modifiers.remove(remesh)
+  bpy.data.meshes.remove(mesh)
+  duct.data.name = name
   if not offset == 0: # flip normals for outer duct wall
-    bpy.ops.object.editmode_toggle()
-    bpy.ops.mesh.select_all(action='SELECT')
-    bpy.ops.mesh.flip_normals()
-    bpy.ops.object.mode_set()
-  bpy.ops.object.modifier_add(type = 'COLLISION')
-  bpy.data.collections['Duct'].objects.link(bpy.context.object)
-  main_collection.objects.unlink(bpy.context.object) # unlink from main collection
+    bm = bmesh.new()
+    bm.from_mesh(duct.data)
+    bmesh.ops.reverse_faces(bm, faces = bm.faces[:])
+    bm.to_mesh(duct.data)
+    bm.free()
+  duct.modifiers.new("Collision", 'COLLISION')
   return
 
-#---- new cell too close to any of the existing cells?
-def too_close(p, dist):
-  for c in cell_centers:
-    if (p-c).length < dist:
-      return True
-  return False
+#---- spatial hash bucket containing a point
+def hash_bucket(p):
+  return (int(p[0] // HASH_SIZE), int(p[1] // HASH_SIZE), int(p[2] // HASH_SIZE))
+
+#---- add a new cell center
+def add_center(p):
+  global cell_centers, n_cells
+  if n_cells == len(cell_centers): # grow the array by doubling
+    cell_centers = np.resize(cell_centers, (2 * len(cell_centers), 3))
+  cell_centers[n_cells] = p
+  cell_hash.setdefault(hash_bucket(p), list()).append(n_cells)
+  n_cells += 1
+  return
+
+#---- new cell closer than sqrt(dist2) (at most HASH_SIZE) to any of the existing cells?
+def too_close(p, dist2):
+  bx, by, bz = hash_bucket(p)
+  idx = list() # indices of the cell centers in the neighbouring buckets
+  for ix in (bx - 1, bx, bx + 1):
+    for iy in (by - 1, by, by + 1):
+      for iz in (bz - 1, bz, bz + 1):
+        idx.extend(cell_hash.get((ix, iy, iz), ()))
+  if not idx:
+    return False
+  diff = cell_centers[idx] - np.asarray(p, dtype=np.float32)
+  return bool(np.any(np.einsum('ij,ij->i', diff, diff) < dist2)) # squared distances, no sqrt
+
+#---- index of the first candidate seed not too close to any existing cell (-1 if none)
+def find_seed(cand, dist2):
+  for j, p in enumerate(cand.tolist()):
+    if not too_close(p, dist2):
+      return j
+  return -1
+
+#---- new material for a cell type
+def cell_material(ctype):
+  mat = bpy.data.materials.new(name = ctype)
+  mat.diffuse_color = cell_types[ctype]["color"]
+  return(mat)
 
 #---- create cells around a duct segment
 def create_seg_cells(s):
-  mat = bpy.data.materials.new(name="mat")
-  mat.diffuse_color = cell_types[s.ctype]["color"]
+  ct = cell_types[s.ctype]
+  settings = dict(cloth_settings, uniform_pressure_force = ct["pressure"], compression_stiffness = ct["stiffness"])
+  mat = cell_materials[s.ctype]
+  cells = bpy.data.collections["Cells"]
 
-  z1 = PTS[s.idx_out].position.z
-  z2 = PTS[s.idx_in].position.z
-  r1 = PTS[s.idx_out].radius + C_OFFSET
-  r2 = PTS[s.idx_in].radius + C_OFFSET
+  z1, z2 = PTS_pos[s.idx_out, 2], PTS_pos[s.idx_in, 2]
+  r1, r2 = PTS_r[s.idx_out] + C_OFFSET, PTS_r[s.idx_in] + C_OFFSET
   r12 = r2 - r1
   z12 = z2 - z1
+  if s.ctype == "acinar":    # squared seed rejection distance
+    dist2 = A_SEP**2
+  else:
+    dist2 = D_SEP**2
+  cx, cy, cz = PTS_pos[s.idx_in] # acinus center
+  ra = 3.5 * C_RADIUS            # acinar cell seed distance from acinus center
+  n = 10000 # candidates (retries) per cell seed, many to help fill gaps in the seed distribution
+  nc = 250  # candidates drawn at a time
+  cand = np.empty((nc, 3))
   for i in range(50): # try to create this number of random cell seeds
-    create = False
-    for j in range(10000): # with many retries to help fill gaps in the seed distribution
-      a1 = random.uniform(0.0, 2.0 * math.pi)
-      if s.ctype == "acinar": # an acinar cell seed placement point
-        a2 = random.uniform(0.0, 0.8 * math.pi) # spherical distribution, but don't cover the duct
-        r = 3.5 * C_RADIUS
-        p = PTS[s.idx_in].position + mathutils.Vector((r*math.sin(a2)*math.cos(a1), r*math.sin(a2)*math.sin(a1), 1.5 * r*math.cos(a2))) 
-        if len(cell_centers)==0 or not too_close(p, 2.8 * C_RADIUS): #   but accept only if not too close to other seeds
-          create = True
-          break
-      else:                    # a duct cell seed placement point
-        z = random.uniform(z1 + C_RADIUS, z2) # not the correct distribution for cones but it doesn't really matter
-        r = random.uniform(0.95,1.05) * (((z-z1)/z12)*r12 + r1) # follow the duct segment cone radius
-        p = mathutils.Vector((r*math.sin(a1), r*math.cos(a1), z))
-        if len(cell_centers)==0 or not too_close(p, 2.5 * C_RADIUS): #   but accept only if not too close to other seeds
-          create = True
-          break
-    if create:
+    j = -1
+    for k in range(0, n, nc): # draw chunks of candidates until one is accepted
+      a1 = rng.uniform(0.0, 2.0 * math.pi, nc)
+      sa1, ca1 = np.sin(a1), np.cos(a1)
+      if s.ctype == "acinar": # acinar cell seed placement points
+        a2 = rng.uniform(0.0, 0.8 * math.pi, nc) # spherical distribution, but don't cover the duct
+        sa2, ca2 = np.sin(a2), np.cos(a2)
+        cand[:, 0] = cx + ra * sa2 * ca1
+        cand[:, 1] = cy + ra * sa2 * sa1
+        cand[:, 2] = cz + 1.5 * ra * ca2
+      else:                   # duct cell seed placement points
+        z = rng.uniform(z1 + C_RADIUS, z2, nc) # not the correct distribution for cones but it doesn't really matter
+        r = rng.uniform(0.95, 1.05, nc) * (((z - z1) / z12) * r12 + r1) # follow the duct segment cone radius
+        cand[:, 0] = r * sa1
+        cand[:, 1] = r * ca1
+        cand[:, 2] = z
+      jc = find_seed(cand, dist2) # accept only if not too close to other seeds
+      if jc >= 0:
+        j = k + jc
+        p = mathutils.Vector(cand[jc])
+        break
+    if j >= 0:
       if j > 5000: print(j) # diagnostic: success with many retries?
-      cell_centers.append(p)
-      bpy.ops.object.duplicate()
-      bpy.context.object.name = "Cell.001"    # duplicate names will auto increment
-      bpy.context.object.data.materials[0] = mat #assign material to object
-      bpy.context.object.location = p
+      add_center(p)
+      obj = bpy.data.objects.new("Cell.%03d" % n_cells, cell_mesh) # all cells share the prototype mesh data
+      cells.objects.link(obj)
+      obj.material_slots[0].link = 'OBJECT' # per cell material, the mesh is shared
+      obj.material_slots[0].material = mat  #assign material to object
+      obj.location = p
       if s.ctype == "acinar": # an acinar cell seed placement point
         scale = random.uniform(0.90, 0.99)
       else:
         scale = random.uniform(0.9, 1.1)
-      bpy.context.object.scale = (scale, scale, scale)
-      bpy.context.object.modifiers["Cloth"].settings.uniform_pressure_force = cell_types[s.ctype]["pressure"]
-      bpy.context.object.modifiers["Cloth"].settings.compression_stiffness = cell_types[s.ctype]["stiffness"]
+      obj.scale = (scale, scale, scale)
+      cloth = obj.modifiers.new("Cloth", 'CLOTH').settings
+      for key, val in settings.items():
+        setattr(cloth, key, val)
+      obj.modifiers.new("Collision", 'COLLISION')
   return
 
 #---- create cells around all of the duct segments
@@ -224,27 +296,20 @@ create_duct(2.0 * C_OFFSET)  # duct outer wall
 
 # create cells collection
 bpy.context.scene.collection.children.link(bpy.data.collections.new(name = "Cells"))
+cell_materials = {ctype: cell_material(ctype) for ctype in cell_types} # one material per cell type
 
-# create prototype cell
-bpy.ops.mesh.primitive_ico_sphere_add(subdivisions = 5, radius = C_RADIUS, location = (0.0, 0.0, 0.0))
-bpy.data.collections["Cells"].objects.link(bpy.context.object)
-main_collection.objects.unlink(bpy.context.object) # unlink from main collection
-
-mat = bpy.data.materials.new(name="mat")
-bpy.context.object.data.materials.append(mat) # add material to object
-
-bpy.ops.object.modifier_add(type = 'CLOTH')
-bpy.context.object.modifiers["Cloth"].settings.use_internal_springs = False
-bpy.context.object.modifiers["Cloth"].settings.use_pressure = True
-bpy.context.object.modifiers["Cloth"].settings.tension_stiffness = 0.01
-
-bpy.ops.object.modifier_add(type = 'COLLISION')
+# create prototype cell mesh
+bm = bmesh.new()
+add_icosphere(bm, 5, C_RADIUS, mathutils.Matrix())
+cell_mesh = bpy.data.meshes.new("Cell")
+bm.to_mesh(cell_mesh)
+bm.free()
+cell_mesh.materials.append(None) # add (empty) material slot
 
-# duplicate prototype cell
+# create cells sharing the prototype mesh
 create_cells()
 
-# remove the prototype cell
-bpy.data.objects.remove(bpy.data.objects['Icosphere'])
+bpy.context.view_layer.update() # a single scene update after all of the objects are created
 
 #-------------------------------------------------------------------------------
 # for standalone version 